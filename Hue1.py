@@ -18,14 +18,39 @@ some error types
 
 import logging
 import json
+import re
+import codecs
+import time
+import threading
+import contextlib
 import requests
-from typing import List, Dict, Optional, Any, Union
+from typing import List, Dict, Optional, Any, Union, Iterator, Iterable, Generator
 Response = Dict[str, Any]
+Snapshot = Dict[int, Response]  # light index -> light state
 
 ___author___ = "jpindar@jpindar.com"
 # If a light is physically off, you can turn it virtually on and off. But you can't set it's hue etc.
 LIGHT_IS_TURNED_OFF = 201
 
+# Priority lanes for commands sent through a Bridge.
+# Interactive commands (a scene, a wall switch) go ahead of any queued background work (set_all, ramps),
+# and background work waits until an interactive burst has been quiet for INTERACTIVE_HOLDOFF seconds.
+INTERACTIVE = 0
+BACKGROUND = 1
+INTERACTIVE_HOLDOFF = 0.5
+
+# size of the pieces a streamed response is read in
+STREAM_CHUNK_SIZE = 8192
+
+# The bridge can take about 10 light commands per second, but only about 1 group command per second.
+# Bridge.lane() spaces every command out by these.
+LIGHT_COMMAND_INTERVAL = 0.1
+GROUP_COMMAND_INTERVAL = 1.0
+
+# light state attributes that restore() puts back, the color ones depend on the light's colormode
+RESTORE_ATTRS = ['on', 'bri', 'effect', 'alert']
+COLOR_ATTRS = {'hs': ['hue', 'sat'], 'xy': ['xy'], 'ct': ['ct']}
+
 log_filename = "Hue1.log"
 enable_logging = False
 logger = logging.getLogger("Hue1")
@@ -86,6 +111,210 @@ def request(method: str, url: str, route: str, **kwargs: Any) -> List[Response]:
         raise e
 
 
+def stream_request(method: str, url: str, route: str, **kwargs: Any) -> Generator[str, None, None]:
+    """ Like request(), but yields the body as text a piece at a time instead of parsing it all at once """
+    try:
+        response: requests.models.Response = requests.request(method, url + '/' + route, stream=True, **kwargs)
+        with response:
+            if response.status_code != requests.codes.ok:   # should be 200
+                raise HueError(0, "Got bad response status from Hue Bridge")
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                yield decoder.decode(chunk)
+            yield decoder.decode(b'', final=True)
+
+    except requests.exceptions.ConnectionError as e:  # this happens when no response
+        logger.error(e.args)
+        raise e
+    except (requests.Timeout, requests.exceptions.RequestException) as e:
+        logger.error(e.args)
+        raise e
+    except Exception as e:
+        logger.error("unknown error condition")
+        logger.error(e.args)
+        raise e
+
+
+class _JsonStream:
+    """ Reads JSON from a stream of text one value at a time,
+        so the objects in a large response can be used without ever holding the whole response.
+        Only objects can be walked into (see members()), anything else is read whole by value() or skipped.
+    """
+
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[^ \t\n\r]')
+    _structure = re.compile(r'["\\{}\[\]]')
+
+    def __init__(self, chunks: Iterator[str]) -> None:
+        self.chunks: Iterator[str] = chunks
+        self.buf: str = ""
+        self.pos: int = 0
+        self.done: bool = False
+
+    def _more(self) -> bool:
+        """ Read another chunk, dropping what has already been used. Returns False at the end of the stream. """
+        for chunk in self.chunks:
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+            return True
+        self.done = True
+        return False
+
+    def peek(self) -> str:
+        """ Skip whitespace and return the next character, or "" at the end of the stream """
+        while True:
+            m = self._whitespace.search(self.buf, self.pos)
+            if m is not None:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self._more():
+                return ""
+
+    def _expect(self, c: str) -> None:
+        if self.peek() != c:
+            raise HueError(0, "Not able to parse bridge data, expected " + c)
+        self.pos += 1
+
+    def value(self) -> Any:
+        """ Read the next value whole """
+        self.peek()
+        while True:
+            try:
+                v, end = self._decoder.raw_decode(self.buf, self.pos)
+                # a number at the very end of the buffer might continue in the next chunk
+                if end < len(self.buf) or self.done:
+                    self.pos = end
+                    return v
+            except json.JSONDecodeError as e:
+                if self.done:
+                    raise HueError(0, "Not able to parse bridge data " + str(e.args))
+            # at least double what we have before trying again, so a big value isn't decoded over and over
+            need = 2 * (len(self.buf) - self.pos)
+            while len(self.buf) - self.pos < need and self._more():
+                pass
+
+    def skip(self) -> None:
+        """ Step over the next value without building it """
+        if self.peek() not in '{[':
+            self.value()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            m = self._structure.search(self.buf, self.pos)
+            if m is None:
+                self.pos = len(self.buf)
+                if not self._more():
+                    raise HueError(0, "Not able to parse bridge data, unexpected end")
+                continue
+            c = m.group()
+            self.pos = m.end()
+            if c == '\\':
+                if self.pos == len(self.buf):
+                    self.pos -= 1
+                    if not self._more():
+                        raise HueError(0, "Not able to parse bridge data, unexpected end")
+                    continue
+                self.pos += 1
+            elif c == '"':
+                in_string = not in_string
+            elif in_string:
+                pass
+            elif c in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def members(self) -> Iterator[str]:
+        """ Walk into an object, yielding its keys.
+            After each key the caller has to read that key's value with value(), skip() or members().
+        """
+        self._expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key: str = self.value()
+            self._expect(':')
+            yield key
+            c = self.peek()
+            self.pos += 1
+            if c == '}':
+                return
+            if c != ',':
+                raise HueError(0, "Not able to parse bridge data, expected , or }")
+
+    def check_for_error(self) -> None:
+        """ Errors come back as a list instead of an object, see request() """
+        if self.peek() == '[':
+            response: List[Response] = self.value()
+            check_response_for_error(response)
+            self.buf, self.pos = json.dumps(response[0]), 0
+
+
+def color_mode(state: Response) -> Optional[str]:
+    """ The colormode that a state, or a message with any of that mode's color attributes, puts a light in """
+    for mode, attrs in COLOR_ATTRS.items():
+        if any(k in state for k in attrs):
+            return mode
+    return None
+
+
+def target_state(state: Response) -> Response:
+    """ The part of a saved light state that can be sent back to the light """
+    if not state.get('on', True):
+        return {'on': False}  # nothing else can be set on a light that's off
+    target: Response = {k: state[k] for k in RESTORE_ATTRS if k in state}
+    if 'alert' in target:
+        target['alert'] = 'none'  # an alert is a one shot thing, don't repeat it
+    for k in COLOR_ATTRS.get(state.get('colormode', ''), []):
+        if k in state:
+            target[k] = state[k]
+    return target
+
+
+def state_diff(target: Response, current: Response) -> Response:
+    """ The attributes of target that differ from the light's current state """
+    diff: Response = {k: v for k, v in target.items() if current.get(k) != v}
+    if target.get('on', False) and 'colormode' in current:
+        # setting the same hue doesn't switch a light in ct mode back to hs mode, so send all of the color
+        colormode = color_mode(target)
+        if colormode is not None and colormode != current['colormode']:
+            for k in COLOR_ATTRS[colormode]:
+                diff[k] = target[k]
+    return diff
+
+
+class LaneStats:
+    """ Latency statistics for one priority lane, in seconds.
+        Latency is measured from when the command was submitted until the bridge answered,
+        so it includes time spent waiting behind other commands.
+    """
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self.last: float = 0.0
+
+    def add(self, latency: float) -> None:
+        self.count += 1
+        self.total += latency
+        self.last = latency
+        if latency > self.max:
+            self.max = latency
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self) -> str:
+        return "LaneStats(count=%d, mean=%.3f, max=%.3f, last=%.3f)" % (self.count, self.mean, self.max, self.last)
+
+
 class Bridge:
 
     def __init__(self, ip_address: str, username: str) -> None:
@@ -94,21 +323,148 @@ class Bridge:
         self.group_list: List[Group] = []
         self.url: str = "http://" + ip_address + "/api/" + username
         self.data: Dict[str, Any] = {}
-
-    def get_all_data(self) -> Response:
-        """ Get all data from the bridge. """
+        self.lane_stats: Dict[int, LaneStats] = {INTERACTIVE: LaneStats(), BACKGROUND: LaneStats()}
+        self._lane_cv = threading.Condition()
+        self._busy: bool = False
+        self._interactive_waiting: int = 0
+        self._last_interactive: Dict[int, float] = {}  # thread id -> when it last sent an interactive command
+        self._next_command: float = 0.0
+
+    @contextlib.contextmanager
+    def lane(self, priority: int = INTERACTIVE, interval: float = LIGHT_COMMAND_INTERVAL) -> Iterator[None]:
+        """ Hold the bridge's command path for one command.
+            Only one command is in flight at a time, and each one starts at least the previous one's interval
+            after the previous one started, to stay within the bridge's command rate.
+            Waiting interactive commands always go first,
+            and background commands also hold off until every other thread's last interactive one is INTERACTIVE_HOLDOFF old.
+            A thread's own interactive commands don't hold off its background ones, since they can't overlap.
+        """
+        start = time.monotonic()
+        with self._lane_cv:
+            if priority == INTERACTIVE:
+                self._interactive_waiting += 1
+                try:
+                    while True:
+                        pace = self._next_command - time.monotonic()
+                        if not self._busy and pace <= 0:
+                            break
+                        self._lane_cv.wait(pace if pace > 0 else None)
+                finally:
+                    # if the wait was interrupted, background commands mustn't be left waiting for us
+                    self._interactive_waiting -= 1
+                    self._lane_cv.notify_all()
+            else:
+                while True:
+                    now = time.monotonic()
+                    holdoff = self._next_command - now
+                    for thread, last in self._last_interactive.items():
+                        if thread != threading.get_ident():
+                            holdoff = max(holdoff, last + INTERACTIVE_HOLDOFF - now)
+                    if not self._busy and self._interactive_waiting == 0 and holdoff <= 0:
+                        break
+                    self._lane_cv.wait(holdoff if holdoff > 0 else None)
+            self._busy = True
+            self._next_command = time.monotonic() + interval
         try:
-            response: List[Response] = request("GET", self.url, '')
-            check_response_for_error(response)
-            self.data = response[0]
+            yield
+        finally:
+            with self._lane_cv:
+                self._busy = False
+                now = time.monotonic()
+                if priority == INTERACTIVE:
+                    # forget threads that have been quiet long enough not to matter
+                    self._last_interactive = {t: last for t, last in self._last_interactive.items()
+                                              if last + INTERACTIVE_HOLDOFF > now}
+                    self._last_interactive[threading.get_ident()] = now
+                self.lane_stats[priority].add(now - start)
+                self._lane_cv.notify_all()
+
+    def request(self, method: str, route: str, priority: int = INTERACTIVE, **kwargs: Any) -> List[Response]:
+        """ Send a request to this bridge through the given priority lane """
+        interval = LIGHT_COMMAND_INTERVAL
+        if method == "PUT" and route.startswith(Group.ROUTE + "/"):
+            interval = GROUP_COMMAND_INTERVAL
+        with self.lane(priority, interval):
+            return request(method, self.url, route, **kwargs)
+
+    @contextlib.contextmanager
+    def stream(self, route: str, priority: int = INTERACTIVE) -> Iterator[_JsonStream]:
+        """ Send a GET to this bridge and read the response incrementally, holding the lane until it's read """
+        with self.lane(priority):
+            chunks = stream_request("GET", self.url, route)
+            try:
+                stream = _JsonStream(chunks)
+                stream.check_for_error()
+                yield stream
+            finally:
+                chunks.close()  # closes the connection if we stopped reading early
+
+    def _read_section(self, stream: _JsonStream, route: str, lists: Dict[str, List[Any]]) -> Response:
+        """ Build the lights, groups or scenes in a streamed response one at a time.
+            They go in lists[route] rather than straight into the bridge,
+            so a stream that fails partway doesn't leave the bridge with half a list (see _keep_lists()).
+        """
+        section: Response = {}
+        if route == Light.ROUTE:
+            light_list: List[Light] = []
+            for i in stream.members():
+                section[i] = stream.value()
+                light_list.append(Light(self, int(i), section[i]))
+            lists[route] = sorted(light_list, key=lambda x: x.index)
+        elif route == Group.ROUTE:
+            # note that while the keys in this look like indexes, they are not necessarily inclusive or ordered
+            group_list: List[Group] = []
+            for i in stream.members():
+                section[i] = stream.value()
+                group_list.append(Group(self, int(i), section[i]))
+            lists[route] = sorted(group_list, key=lambda x: x.name)
+        elif route == Scene.ROUTE:
+            scene_list: List[Scene] = []
+            for i in stream.members():
+                section[i] = stream.value()
+                scene_list.append(Scene(self, i, section[i]))
+            lists[route] = sorted(scene_list, key=lambda x: x.name)
+        else:
+            section = stream.value()
+        return section
+
+    def _keep_lists(self, lists: Dict[str, List[Any]]) -> None:
+        """ Replace the bridge's lists with the ones _read_section() built, once the whole response has been read """
+        if Light.ROUTE in lists:
+            self.light_list = lists[Light.ROUTE]
+        if Group.ROUTE in lists:
+            self.group_list = lists[Group.ROUTE]
+        if Scene.ROUTE in lists:
+            self.scene_list = lists[Scene.ROUTE]
+
+    def get_all_data(self, sections: Optional[Iterable[str]] = None, priority: int = INTERACTIVE) -> Response:
+        """ Get all data from the bridge.
+            sections picks which top level sections ('lights', 'scenes', 'config', etc.) to keep, default is all.
+            The response is parsed as it arrives, and unwanted sections are skipped without being built.
+            Lights, groups and scenes also update light_list, group_list and scene_list, sharing the same dicts.
+            On a big installation this is bulk work, so consider priority=BACKGROUND.
+            Nothing on the bridge object changes unless the whole response is read.
+        """
+        wanted = None if sections is None else set(sections)
+        data: Response = {}
+        lists: Dict[str, List[Any]] = {}
+        try:
+            with self.stream('', priority) as stream:
+                for section in stream.members():
+                    if wanted is None or section in wanted:
+                        data[section] = self._read_section(stream, section, lists)
+                    else:
+                        stream.skip()
         except HueError as e:
             logger.error(e.args)
             raise e
+        self.data = data
+        self._keep_lists(lists)
         return self.data
 
     def get_config(self) -> Response:
         try:
-            response: List[Response] = request("GET", self.url, "config")
+            response: List[Response] = self.request("GET", "config")
             check_response_for_error(response)
         except HueError as e:
             logger.error(e.args)
@@ -124,43 +480,41 @@ class Bridge:
     def delete_user(self, id: str) -> None:
         route = "config/whitelist/" + str(id)
         try:
-            response: List[Response] = request("DELETE", self.url, route)
+            response: List[Response] = self.request("DELETE", route)
             check_response_for_error(response)
         except HueError as e:
             logger.error(e.args)
             raise e
 
-    def get_lights(self) -> List['Light']:
+    def get_lights(self, priority: int = INTERACTIVE) -> List['Light']:
         """
             Get a list of the bridge's lights.
             Note that light.index starts at 1 but list positions start at 0
         """
+        lists: Dict[str, List[Any]] = {}
         try:
-            response: List[Response] = request("GET", self.url, Light.ROUTE)
-            check_response_for_error(response)
+            with self.stream(Light.ROUTE, priority) as stream:
+                self._read_section(stream, Light.ROUTE, lists)
         except HueError as e:
             logger.error("Hue Error " + str(e.args))
             raise e
-        r = response[0]
-        self.light_list = [Light(self, int(i), r[str(i)]) for i in r.keys()]
-        self.light_list = sorted(self.light_list, key=lambda x: x.index)
+        self._keep_lists(lists)
         return self.light_list
 
-    def get_scenes(self) -> List['Scene']:
+    def get_scenes(self, priority: int = INTERACTIVE) -> List['Scene']:
+        lists: Dict[str, List[Any]] = {}
         try:
-            response: List[Response] = request("GET", self.url, Scene.ROUTE)
-            check_response_for_error(response)
+            with self.stream(Scene.ROUTE, priority) as stream:
+                self._read_section(stream, Scene.ROUTE, lists)
         except HueError as e:
             logger.error(e.args)
             raise e
-        r = response[0]
-        self.scene_list = [Scene(self, i, r[str(i)]) for i in r.keys()]
-        self.scene_list = sorted(self.scene_list, key=lambda x: x.name)
+        self._keep_lists(lists)
         return self.scene_list
 
     def get_groups(self) -> List['Group']:
         try:
-            response: List[Response] = request("GET", self.url, Group.ROUTE)
+            response: List[Response] = self.request("GET", Group.ROUTE)
             check_response_for_error(response)
         except HueError as e:
             logger.error(e.args)
@@ -188,7 +542,7 @@ class Bridge:
     def delete_scene(self, scene: 'Scene') -> None:
         route = Scene.ROUTE + "/" + str(scene.id)
         try:
-            response: List[Response] = request("DELETE", self.url, route)
+            response: List[Response] = self.request("DELETE", route)
             check_response_for_error(response)
         except HueError as e:
             logger.error(e.args)
@@ -197,7 +551,7 @@ class Bridge:
     def delete_group(self, group: 'Group') -> None:
         route = Group.ROUTE + "/" + str(group.id)
         try:
-            response: List[Response] = request("DELETE", self.url, route)
+            response: List[Response] = self.request("DELETE", route)
             check_response_for_error(response)
         except HueError as e:
             logger.error(e.args)
@@ -217,6 +571,73 @@ class Bridge:
                 return light
         return None
 
+    def snapshot(self, priority: int = INTERACTIVE) -> Snapshot:
+        """ Save the state of every light, using one request """
+        self.get_lights(priority)
+        return {light.index: dict(light.state) for light in self.light_list}
+
+    def _find_group(self, diff: Response, lights: List[int], current: Snapshot, targets: Snapshot) -> Optional['Group']:
+        """ Find the group that sends diff to the most of lights,
+            without changing any other light that doesn't already have those values
+        """
+        def unaffected(i: int) -> bool:
+            if i not in current:
+                return True
+            state = current[i]
+            mode = color_mode(diff)
+            if all(state.get(k) == v for k, v in diff.items()) and (mode is None or state.get('colormode') == mode):
+                return True
+            # a light that's staying off doesn't care about anything but 'on'
+            return not state.get('on', False) and 'on' not in diff and targets.get(i) == {'on': False}
+
+        best: Optional[Group] = None
+        best_count = 1
+        # only groups we already know about, looking them up would cost a request
+        for group in [Group(self, 0)] + self.group_list:  # group 0 is all lights
+            members = list(current) if group.id == 0 else [int(i) for i in group.lights]
+            count = len([i for i in members if i in lights])
+            if count > best_count and all(i in lights or unaffected(i) for i in members):
+                best, best_count = group, count
+        return best
+
+    def restore(self, snapshot: Snapshot, priority: int = BACKGROUND) -> int:
+        """ Put the lights back the way they were in snapshot, sending only what has changed.
+            Lights that need the same change are sent one group command when there's a group that fits.
+            Returns the number of commands sent.
+        """
+        current: Snapshot = self.snapshot(priority)
+        targets: Snapshot = {i: target_state(state) for i, state in snapshot.items() if i in current}
+        # bucket the lights by the change they need
+        changes: Dict[str, List[int]] = {}
+        for i, target in targets.items():
+            diff = state_diff(target, current[i])
+            if diff:
+                changes.setdefault(json.dumps(diff, sort_keys=True), []).append(i)
+
+        sent = 0
+        for msg, lights in changes.items():
+            diff = json.loads(msg)
+            sent_to: List[int] = []
+            group = self._find_group(diff, lights, current, targets)
+            while group is not None:
+                group.send(msg, priority)
+                sent += 1
+                members = list(current) if group.id == 0 else [int(i) for i in group.lights]
+                sent_to += members
+                lights = [i for i in lights if i not in members]
+                group = self._find_group(diff, lights, current, targets)
+            for i in lights:
+                Light(self, i).send(msg, priority)
+                sent += 1
+            sent_to += lights
+            # keep track of what we've changed, so later buckets know what the lights have now
+            for i in sent_to:
+                if i in current:
+                    current[i].update(diff)
+                    if color_mode(diff) is not None:
+                        current[i]['colormode'] = color_mode(diff)
+        return sent
+
     def all_on(self, on: bool) -> None:
         group: Group = Group(self, 0)  # group 0 is all lights
         group.set('on', on)
@@ -226,9 +647,9 @@ class Bridge:
             Since you can use group 0 for all lights, this is just an example.
             value can be bool or int, not sure about str
         """
-        self.get_lights()
+        self.get_lights(BACKGROUND)
         for light in self.light_list:
-            light.set(attr, value)
+            light.set(attr, value, BACKGROUND)
 
 
 class Scene:
@@ -274,11 +695,13 @@ class Group:
             except KeyError as e:
                 raise HueError(0, "Not able to parse group data" + str(e.args))
 
-    def set(self, attr: str, value: Any) -> None:
+    def set(self, attr: str, value: Any, priority: int = INTERACTIVE) -> None:
+        self.send(json.dumps({attr: value}), priority)
+
+    def send(self, msg: str, priority: int = INTERACTIVE) -> None:
         route = self.ROUTE + "/" + str(self.id) + "/action"
-        msg: str = json.dumps({attr: value})
         try:
-            response: List[Response] = request("PUT", self.bridge.url, route, data=msg)
+            response: List[Response] = self.bridge.request("PUT", route, priority, data=msg)
             #  r should be a list of dicts such as [{'success':{/lights/1/state/on':True}]
             #  1st element of 1st element == 'success'
             check_response_for_error(response)
@@ -307,7 +730,7 @@ class Light:
     def get_data(self) -> Response:
         route = self.ROUTE + "/" + str(self.index)
         try:
-            response: List[Response] = request("GET", self.bridge.url, route)
+            response: List[Response] = self.bridge.request("GET", route)
             check_response_for_error(response)
             self.data = response[0]
             self.name = self.data['name']
@@ -317,7 +740,7 @@ class Light:
             logger.error(e.args)
             raise e
 
-    def set(self, attr: str, value: Any) -> None:
+    def set(self, attr: str, value: Any, priority: int = INTERACTIVE) -> None:
         if isinstance(value, str):
             if value.lower() == "true":
                 value = True
@@ -325,12 +748,12 @@ class Light:
                 value = False
             elif value.lstrip("-+").isdigit():  # oddly, there is no is_int() function
                 value = int(value)
-        self.send(json.dumps({attr: value}))
+        self.send(json.dumps({attr: value}), priority)
 
-    def send(self, msg: str) -> None:
+    def send(self, msg: str, priority: int = INTERACTIVE) -> None:
         route = self.ROUTE + "/" + str(self.index) + "/state"
         try:
-            response: List[Response] = request("PUT", self.bridge.url, route, data=msg)
+            response: List[Response] = self.bridge.request("PUT", route, priority, data=msg)
             #  r is a list of dicts such as [{'success':{/lights/1/state/on':True}]
             #  1st element of 1st element should be 'success'
             # it will be 'success' if the light is physically turned off
@@ -4,6 +4,8 @@ Author: jpindar@jpindar.com
 
 """
 import logging
+import threading
+import tracemalloc
 from Hue1 import *
 
 
@@ -130,7 +132,7 @@ def test_light_commands(bridge:Bridge) -> None:
         try:
             # ct 	uint16 	The Mired Color temperature of the light. 2012 connected lights are capable of 153 (6500K) to 500 (2000K).
             for t in range(153, 501, 50):
-                light.set("ct",t)
+                light.set("ct",t, BACKGROUND)
         except HueError as e:
             print("Hue Error type " + str(e.type) + " " + e.description)
 
@@ -151,6 +153,54 @@ def test_light_commands(bridge:Bridge) -> None:
         bridge.all_on(False)
 
 
+def test_priority_lanes(bridge:Bridge) -> None:
+    # a background ramp in another thread shouldn't delay the interactive commands
+    ramp = threading.Thread(target=bridge.set_all, args=("ct", 300))
+    ramp.start()
+    bridge.all_on(True)
+    scene = bridge.get_scene_by_name("Energize")
+    if scene is not None:
+        scene.display()
+    ramp.join()
+    print(bridge.lane_stats)
+
+
+def test_memory_usage(bridge:Bridge) -> None:
+    # compare peak memory of parsing the whole response at once against streaming it
+    tracemalloc.start()
+    request("GET", bridge.url, '')
+    print("whole response: peak %d bytes" % tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    for sections in (None, ["lights"]):
+        tracemalloc.start()
+        Bridge(ip_address, username).get_all_data(sections)
+        print("streamed " + str(sections) + ": peak %d bytes" % tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+
+def test_snapshot_restore(bridge:Bridge) -> None:
+    # save everything, run some temporary effects, then put it all back
+    snapshot = bridge.snapshot()
+    print(snapshot)
+    bridge.all_on(True)
+    bridge.set_all("effect", "colorloop")
+    bridge.set_all("alert", "lselect")
+    n = bridge.restore(snapshot)
+    print("restored with " + str(n) + " commands")
+    # restoring again shouldn't need to send anything
+    n = bridge.restore(snapshot)
+    print("restored again with " + str(n) + " commands")
+
+    # the lights have different colors, but every one needs the same change to undo the effect,
+    # so this should take one group command
+    bridge.all_on(True)
+    snapshot = bridge.snapshot()
+    bridge.set_all("effect", "colorloop")
+    bridge.set_all("alert", "lselect")
+    n = bridge.restore(snapshot)
+    print("restored the effect with " + str(n) + " commands")
+
+
 def test_bad_commands() -> None:
     bridge = Bridge(ip_address, username)
     try:
@@ -222,6 +272,9 @@ def main() -> None:
     test_light_thats_off()
     test_group_commands(bridge)
     test_scene_commands(bridge)
+    test_priority_lanes(bridge)
+    test_memory_usage(bridge)
+    test_snapshot_restore(bridge)
     test_bad_commands()
     bridge.all_on(False)
 